@@ -25,6 +25,7 @@ Features that could be added-
 """
 
 import logging
+import operator
 import sys
 
 logging.basicConfig(level=logging.WARNING)
@@ -35,17 +36,122 @@ def log_helper(name, c):
 # The markers X and O
 pegs = 'OX'
 
+# Placements are stored as one byte per slot: 0 for empty, 1 for X, 2 for O.
+_PEG_CODE = {' ': 0, 'X': 1, 'O': 2}
+_CODE_PEG = ' XO'
+
+_OPPOSITE = {'X': 'O', 'O': 'X'}
+
 def opposite(peg):
-    return pegs.replace(peg, '')
+    return _OPPOSITE[peg]
 
 def cross(s1, s2):
     return [e1+e2 for e1 in s1 for e2 in s2]
 
-def diag(s1, s2):
-    assert (len(s1) == len(s2))
-    return [(s1[i]+s2[i]) for i in range(len(s1))]
+def line_mask(start, step, m):
+    return reduce(operator.or_, [1 << (start + i*step) for i in range(m)])
+
+def _score(win_masks, p1_mask, p2_mask, weights, n_slots):
+    """
+    The scoring kernel behind Board._best_offensive_move, kept free of
+    any Board state so that it only touches locals in its loop.
+    weights[k] is the weight of a set that has k of p1's pegs in it.
+    Returns (slot_weights, win_indicator, win_bit).
+    """
+    m = len(weights) - 1
+    win_indicator = -1
+    win_bit = 0
+    slot_weights = [0] * n_slots
+    for wm in win_masks:
+        # Any set that has the other players peg is no good for me.
+        if wm & p2_mask:
+            continue
+        # p1 could still win with this set.
+        if win_indicator == -1:
+            win_indicator = 0
+
+        # vac are the slots that still need to be filled up for this set.
+        # (bin().count() is the popcount of vac)
+        vac = wm & ~p1_mask
+        vacant = bin(vac).count('1')
+        # no vacant slot for a set == p1 won already 
+        if vacant == 0:
+            win_indicator = 1
+        # exactly one vacant slot left == p1 wins by playing there
+        elif vacant == 1 and not win_bit:
+            win_bit = vac
+
+        # s3cret sauce: the set is more important for p1 if it already
+        # has more pegs filled in already (ie less vacancy).
+        # and more important == exponentially more important.
+        extra_weight = weights[m - vacant]
+        while vac:
+            b = vac & -vac
+            slot_weights[b.bit_length() - 1] += extra_weight
+            vac ^= b
+    return (slot_weights, win_indicator, win_bit)
+
+# Small boards have few enough positions to remember the best_slot() result
+# of every position seen so far: (my_peg, p1_mask, p2_mask, defensiveness)
+# -> (best_slot, comment). Shared by every Board of that size.
+_lookup_tables = {(3, 3): {}}
+
+# Board structures only depend on (board_size, win_size), so they are built
+# once per size and shared (read-only) by every Board of that size.
+_structures_cache = {}
+
+def _build_structures(n, m):
+    """
+    Returns (slots, slot_idx, win_masks, weights) for a nxn board with
+    m-in-a-row to win.
+    The returned structures are shared, do not modify them.
+    """
+    key = (n, m)
+    if key in _structures_cache:
+        return _structures_cache[key]
+
+    # This gives row index line as pretty alpha chars (a,b,c...)
+    rows = map(lambda x:chr(97+x), range(n))
+    cols = rows
+
+    # All slots of the board (aa, ab, ac.. ba, bc..)
+    slots = cross(rows, cols)
+    assert(n ** 2 == len(slots))
+    log_helper("slots", slots)
+
+    # Slot i of slots is bit i of the bitboards.
+    slot_idx = dict((s, i) for (i, s) in enumerate(slots))
+
+    # win_sets: All possible sets of contiguous slots, each of size m.
+    # If at least one of these set has all pegs of the same kind,
+    # that peg wins the game.
+    # win_sets are computed in parts from 4 directional sets, straight as
+    # bitmasks of the slots: a set starting at slot index start is m slots
+    # that are step apart.
+    k = n - m + 1
+    vert_sets = [line_mask(r*n + i, 1, m) \
+                    for r in range(n) for i in range(k)] 
+    horz_sets = [line_mask(i*n + c, n, m) \
+                    for c in range(n) for i in range(k)]
+    dia1_sets = [line_mask(i*n + j, n + 1, m) \
+                    for i in range(k) for j in range(k)]
+    dia2_sets = [line_mask(i*n + j + m - 1, n - 1, m) \
+                    for i in range(k) for j in range(k)]
+
+    win_masks = vert_sets + horz_sets + dia1_sets + dia2_sets
+    assert(2*(2*n-m+1)*(n-m+1) == len(win_masks)) 
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        log_helper("win_sets", [[slots[i] for i in range(n*n) if (wm >> i) & 1] \
+                                for wm in win_masks])
+
+    # Weight of a win_set with k of the player's pegs in it.
+    weights = [pow(5, k) for k in range(m + 1)]
+
+    structures = (slots, slot_idx, win_masks, weights)
+    _structures_cache[key] = structures
+    return structures
     
-class Board:
+class Board(object):
     """ 
     Representation of a nxn board of tic-tac-toe.
     
@@ -65,26 +171,28 @@ class Board:
         board object multiple times but it is not necessary to do so.
         
         How it works:
-            (in _initialize_structures)
+            (in _build_structures, once per board size)
             Given the board constrains (board_size and win_size), we try to
             find all the set of slots that result in victory if all pegs in the 
-            slot are of the same type. This is the win_sets structure.
+            slot are of the same type. This is the win_sets structure, which
+            is only kept in its bitmask form (win_masks, see below).
             
-            The slot_to_winsets structure maps each of the slot to the set of 
-            win_sets that the slot influences. Essentially, these win_sets are 
-            those which contain this slot.
+            The board itself is kept as a bytearray of peg codes (_placements)
+            plus two bitboards (_p1_mask for X and 
+            _p2_mask for O) with one bit per slot, and every win_set is 
+            precomputed as a mask of its slots' bits (win_masks).
             
             (in _best_offensive_move)
             Consider an offensive game (where P1 is only trying to finish his 
             m-in-a-row goal and not trying to stop his opponent).             
             P1 can win iff there is at least one win_set which has all pegs of his type.
-            When iterating over the win_sets for P1, we first discard all win_sets
-            that contain even a single peg of the opponent (using slot_to_winsets)
+            When iterating over the win_masks for P1, we first discard all win_sets
+            that contain even a single peg of the opponent (win_mask & p2_mask)
             - there is no way P1 can win by putting his peg in one of these.
             
-            We get all the win_sets in can_win_sets. 
-            For each of these win_sets, we look at every slot in the set and count
-            the number of slots that already has P1's peg in it. A win_set that 
+            For each of the remaining win_sets, we look at the vacant slots in 
+            the set (win_mask & ~p1_mask) to count the number of slots that 
+            already has P1's peg in it. A win_set that 
             has more number of P1's peg is lot more important for the player and 
             it is very important for P1 to be able to finish them. Hence, we give
             high weights to the empty slots in that win_set. This weight is 
@@ -93,179 +201,204 @@ class Board:
             the vacant slots in the win_set).
             
             (in best_slot)
-            We get a dict of weights for each available slots in the board.
+            We get a list of weights for each slot in the board (indexed like
+            the slots, i.e. by bit position).
             We now rerun the _best_offensive_move looking from the opponent's 
             point of view - as in which are the slots that are important for the 
             opponent to finish.
             
-            These dicts (w1 and w2) are added together in a weighed proportion 
+            While weighing, _best_offensive_move also notes a slot (if any) that
+            finishes a win_set right away. If we have one we simply play there, 
+            else if the opponent has one we block it.
+
+            Otherwise, these lists (w1 and w2) are added together in a weighed proportion 
             (decided by defensiveness) to get the combined weights.
             By default, we use defensiveness = 5, which means the opponents' weight
             are 5 times more important fot us than our own. Which means that it is 
             a lot more important for us to stop the opponent from winning than to 
             win ourself.
             
-            From the final dict, we pick a slot with the highest weight and return it
+            From the final weights, we pick an empty slot with the highest weight and return it
             as the best slot.
               
     """
+    # Boards get created a lot (once per move is fine), keep them small.
+    __slots__ = ('_board_size', '_win_size', '_slots', '_slot_idx',
+                 '_win_masks', '_weights', '_table', '_placements',
+                 '_p1_mask', '_p2_mask')
+
     def __init__(self, board_size, win_size, board_string = None):
         assert(win_size <= board_size)
         self._board_size = board_size
         self._win_size = win_size
         self._initialize_structures()
+        self._table = _lookup_tables.get((board_size, win_size))
         if board_string == None:
             board_string = ' ' * (self._board_size ** 2)
-        self._placements = self._parse_board(board_string)
+        self.set_board(board_string)
 
     def _initialize_structures(self):
-        # This gives row index line as pretty alpha chars (a,b,c...)
-        self._rows = map(lambda x:chr(97+x), range(self._board_size))
-        self._cols = self._rows
-
-        # All slots of the board (aa, ab, ac.. ba, bc..)
-        self._slots = cross(self._rows, self._cols)
-        assert(self._board_size ** 2 == len(self._slots))
-        log_helper("self._slots", self._slots)
-
-        # win_sets: All possible sets of contiguous slots, each of size m.
-        # If at least one of these set has all pegs of the same kind,
-        # that peg wins the game.
-        # win_sets are computed in parts from 4 directional sets.
-        n = self._board_size
-        m = self._win_size
-        k = n - m + 1
-        vert_sets = [cross(r, self._cols[i:i+m]) \
-                        for r in self._rows for i in range(k)] 
-        horz_sets = [cross(self._rows[i:i+m], c) \
-                        for c in self._cols for i in range(k)]
-        dia1_sets = [diag(self._rows[i:i+m], self._cols[j:j+m]) \
-                        for i in range(k) for j in range(k)]
-        dia2_sets = [diag(self._rows[i:i+m], self._cols[j:j+m][::-1]) \
-                        for i in range(k) for j in range(k)]
-
-        self._win_sets = vert_sets + horz_sets + dia1_sets + dia2_sets
-        assert(2*(2*n-m+1)*(n-m+1) == len(self._win_sets)) 
-        log_helper("win_sets", self._win_sets);
-
-        # The winning sets for each slot.
-        # Map from every slot in the board to the set of wining_sets they influence.
-        self._slot_to_winsets = dict((s, [m for m in self._win_sets if s in m]) \
-                                     for s in self._slots)
-        log_helper("slot_to_winsets", self._slot_to_winsets)
-
-    def best_slot(self, my_peg, defensiveness = 5.0):
+        (self._slots, self._slot_idx, self._win_masks, self._weights) = \
+            _build_structures(self._board_size, self._win_size)
+
+    def best_slot(self, my_peg, defensiveness = 5):
         """
         Returns tuple(best_slot, comment) 
         If best_slot is None, the game is over and reason is given in the comment.
         Find the best next slot for my_pegs for the board.
         defensiveness is the fuzz factor which decides whether it is more
         important to win ourself or stop the other player from winning.
+        With an int defensiveness (the default) all the scoring stays in
+        integer arithmetic; a float works too but makes the weights floats.
         """
-        empty_slots = [s for s in self._slots if self._placements[s] == ' '] 
-        my_slots = [s for s in self._slots if self._placements[s] == my_peg] 
-        opp_slots = [s for s in self._slots if self._placements[s] == opposite(my_peg)] 
-        
+        # The masks are kept up to date by add_placement() and set_board().
+        return self._lookup_best_slot(my_peg, self._p1_mask, self._p2_mask,
+                                      defensiveness)
+
+    def best_slots_batch(self, p1_masks, p2_masks, my_peg, defensiveness = 5):
+        """
+        Returns a list with the best_slot() tuple for each of many positions
+        of this board size, without setting up the board for every one.
+        p1_masks and p2_masks are equally long sequences of bitmasks of the
+        slots that hold X and O; bit i is the i-th slot in row-major order
+        (ie. bit r*n + c for row r and column c).
+        This is a plain loop over the positions, with no vectorized scoring.
+        """
+        assert(my_peg in pegs and len(my_peg) == 1)
+        assert(len(p1_masks) == len(p2_masks))
+        limit = 1 << len(self._slots)
+        results = []
+        for (p1_mask, p2_mask) in zip(p1_masks, p2_masks):
+            # Same sanity as the board string gives: every mask fits the
+            # board and no slot holds both pegs.
+            assert(0 <= p1_mask < limit and 0 <= p2_mask < limit)
+            assert(p1_mask & p2_mask == 0)
+            results.append(self._lookup_best_slot(my_peg, p1_mask, p2_mask,
+                                                  defensiveness))
+        return results
+
+    def _lookup_best_slot(self, my_peg, p1_mask, p2_mask, defensiveness):
+        # Rendering the weights is not free, only do it if it gets logged.
+        verbose = logging.getLogger().isEnabledFor(logging.INFO)
+        if self._table == None or verbose:
+            return self._best_slot(my_peg, p1_mask, p2_mask, defensiveness, verbose)
+
+        key = (my_peg, p1_mask, p2_mask, defensiveness)
+        result = self._table.get(key)
+        if result == None:
+            result = self._best_slot(my_peg, p1_mask, p2_mask, defensiveness, verbose)
+            self._table[key] = result
+        return result
+
+    def _best_slot(self, my_peg, p1_mask, p2_mask, defensiveness, verbose):
+        opp_peg = _OPPOSITE[my_peg]
+        if my_peg == 'X':
+            (my_mask, opp_mask) = (p1_mask, p2_mask)
+        else:
+            (my_mask, opp_mask) = (p2_mask, p1_mask)
+        taken = my_mask | opp_mask
+
         # If there are no more slots to play then report the game is over.
-        if len(empty_slots) == 0:
+        if taken == (1 << len(self._slots)) - 1:
             return (None, "GAME DRAW !!")
     
-        (w1, i1) = self._best_offensive_move(my_peg, my_slots, opp_slots, empty_slots)        
-        logging.info("== offensive slot weights for self ==\n" + self._board_string(w1)) 
+        (w1, i1, my_win_bit) = self._best_offensive_move(my_mask, opp_mask)
+        if verbose:
+            logging.info("== offensive slot weights for self ==\n" + self._board_string(w1))
 
-        (w2, i2) = self._best_offensive_move(opposite(my_peg), opp_slots, my_slots, empty_slots)        
-        logging.info("== offensive slot weights for opponent ==\n" + self._board_string(w2)) 
+        (w2, i2, opp_win_bit) = self._best_offensive_move(opp_mask, my_mask)
+        if verbose:
+            logging.info("== offensive slot weights for opponent ==\n" + self._board_string(w2))
 
         if (i1 == 1):
             return (None, my_peg + " has won !!")
         if (i2 == 1):
-            return (None, opposite(my_peg) + " has won !!")
+            return (None, opp_peg + " has won !!")
+
+        # A slot that wins the game right away for us is played as is, else
+        # one that would win it for the opponent has to be blocked.
+        if my_win_bit:
+            return (self._slots[my_win_bit.bit_length() - 1], '')
+        if opp_win_bit:
+            return (self._slots[opp_win_bit.bit_length() - 1], '')
+
         if (i1 == -1 and i2 == -1):
             return (None, "The game is draw !!")
     
-        slot_weights = dict((s, w1[s] + defensiveness * w2[s]) for s in w1.keys())    
-        logging.info("== aggregate slot weights for my next move ==\n" + self._board_string(slot_weights)) 
+        weights = [a + defensiveness * b for (a, b) in zip(w1, w2)]
+        if verbose:
+            logging.info("== aggregate slot weights for my next move ==\n" + self._board_string(weights))
     
-        best_slot = max(slot_weights, key=slot_weights.get)
-        return (best_slot, '')
+        empty_indices = [i for i in range(len(self._slots)) if not (taken >> i) & 1]
+        best_index = max(empty_indices, key=weights.__getitem__)
+        return (self._slots[best_index], '')
 
-    def _best_offensive_move(self, p1_peg, p1_slots, p2_slots, empty_slots):    
+    def _best_offensive_move(self, p1_mask, p2_mask):
         """
-        Returns (slot_scores, indicator) tuple.
-        slot_scores is a dict contains scores for each available slot.
+        Returns (slot_scores, indicator, win_bit) tuple.
+        slot_scores is a list of scores indexed like self._slots (bit i of
+        the masks). Slots that are not vacant always score 0.
+        win_bit is the bit of a slot that finishes a win_set for p1 right
+        away (0 if there is no such slot).
         slot_scores are meaningful iff indicator == 0
         indicator == -1 means p1 can not win anymore.
         indicator ==  1 means p1 has won already.
         indicator ==  0 means continue playing.
         
-        Given the current state of the board (described by sets of slots),
-        returns the best move for p1 to finish one of his rows. 
+        Given the current state of the board (described by the bitmasks of
+        the slots held by each player), returns the best move for p1 to
+        finish one of his rows.
         This does not (actively) try to disrupt the building plans of the 
         opponents (though this is used in reverse to do exactly that).
         """
-        # Any slots that have the other players peg is no good for me.
-        can_not_win_sets = sum([self._slot_to_winsets[s] for s in p2_slots], [])    
-        log_helper("can_not_win_sets for %s" % p1_peg, can_not_win_sets)
-
-        # Sets where p1 could still win.
-        can_win_sets = [s for s in self._win_sets if s not in can_not_win_sets]   
-        log_helper("can_win_sets for %s" % p1_peg, can_win_sets)
-
-        win_indicator = 0
-        # Can not win this game anymore
-        if len(can_win_sets) == 0:
-            win_indicator = -1
-        
-        slot_weights = dict((s, 0) for s in empty_slots)
-        for cw in can_win_sets:
-            # vacant_slots are slots that still need to be filled up for
-            # each can_win set.
-            vacant_slots = set(cw) - set(p1_slots)        
-            # no vacant slot for a set == p1 won already 
-            if len(vacant_slots) == 0:
-                win_indicator = 1
-
-            # s3cret sauce: the set is more important for p1 if it already
-            # has more pegs filled in already (ie less vacancy).
-            # and more important == exponentially more important.
-            extra_weight = pow(5, self._win_size - len(vacant_slots))
-            for s in vacant_slots:
-                slot_weights[s] += extra_weight
-        return (slot_weights, win_indicator)
+        return _score(self._win_masks, p1_mask, p2_mask,
+                      self._weights, len(self._slots))
 
     def add_placement(self, slot, peg):
-        assert(self._placements.get(slot) == ' ')
-        self._placements[slot] = peg
+        assert(peg in pegs and len(peg) == 1)
+        i = self._slot_idx[slot]
+        assert(self._placements[i] == 0)
+        code = _PEG_CODE[peg]
+        self._placements[i] = code
+        if code == 1:
+            self._p1_mask |= 1 << i
+        else:
+            self._p2_mask |= 1 << i
         
     def set_board(self, board_string):
         self._placements = self._parse_board(board_string)
+        self._p1_mask = 0
+        self._p2_mask = 0
+        for (i, c) in enumerate(self._placements):
+            if c == 1:
+                self._p1_mask |= 1 << i
+            elif c == 2:
+                self._p2_mask |= 1 << i
 
     def _parse_board(self, board_str):
         """
         Read the board as a string.
         Valid characters are O and X and a space or dot for empty cell.
         Any other character is embellishment and is safely ignored.
-        Returns a dict that maps each slot to the peg or ' ' if empty.
+        Returns a bytearray with the peg code (see _PEG_CODE) of every slot.
         """
         #TODO: Parse variations (ignore case, can use any char as delimiter)
         chars = [c for c in board_str.replace('.', ' ') if c in pegs + ' ']
         assert (self._board_size ** 2 == len(chars))
-        return dict(zip(self._slots, chars))
-
-    def _board_string(self, dict = None):
-        if dict == None:
-            dict = self._placements
-
-        buffer = ''
-        i = 0
-        for s in self._slots:
-            buffer += str(dict.get(s))
-            i += 1
-            if i % self._board_size != 0:
-                buffer += ' | '
-            elif i < self._board_size ** 2: 
-                buffer += '\n' + "----" * self._board_size + '\n'
-        return buffer
+        return bytearray(_PEG_CODE[c] for c in chars)
+
+    def _board_string(self, values = None):
+        """
+        values is indexed like self._slots; defaults to the pegs on the board.
+        """
+        if values == None:
+            values = [_CODE_PEG[c] for c in self._placements]
+
+        n = self._board_size
+        row_sep = '\n' + "----" * n + '\n'
+        rows = [' | '.join([str(v) for v in values[i:i+n]]) \
+                for i in range(0, n * n, n)]
+        return row_sep.join(rows)
 
     def __str__(self):
         return self._board_string()